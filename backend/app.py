@@ -1,12 +1,30 @@
 import os
-import shutil
-from typing import List, Optional
+from contextlib import asynccontextmanager
+from typing import TYPE_CHECKING, List, Optional
+import aiofiles
 from fastapi import FastAPI, UploadFile, File, HTTPException, Header
 from fastapi.middleware.cors import CORSMiddleware
-from backend.rag_engine import RAGEngine
+from starlette.concurrency import run_in_threadpool
+from backend.loaders import HTML_EXTENSIONS
 from backend.models import TestCaseRequest, TestPlan, SeleniumScriptRequest, SeleniumScriptResponse
 
-app = FastAPI(title="Autonomous QA Agent API")
+if TYPE_CHECKING:
+    from backend.rag_engine import RAGEngine
+
+# Created on startup rather than at import: document-loading worker processes
+# re-import this module and must not load the embedding model or Chroma.
+rag_engine: "RAGEngine | None" = None
+
+
+@asynccontextmanager
+async def lifespan(app: FastAPI):
+    global rag_engine
+    from backend.rag_engine import RAGEngine
+    rag_engine = RAGEngine()
+    yield
+
+
+app = FastAPI(title="Autonomous QA Agent API", lifespan=lifespan)
 
 # Configure CORS from environment variable (comma-separated origins)
 allowed = os.environ.get("BACKEND_ALLOWED_ORIGINS", "*")
@@ -24,63 +42,74 @@ app.add_middleware(
 )
 
 UPLOAD_DIR = "data/uploads"
-HTML_EXTENSIONS = (".html", ".htm")
+UPLOAD_CHUNK_SIZE = 1 << 20  # 1 MiB
 os.makedirs(UPLOAD_DIR, exist_ok=True)
 
-rag_engine = RAGEngine()
-
 @app.post("/upload-documents")
 async def upload_documents(files: List[UploadFile] = File(...)):
     saved_paths = []
     # Clear old uploads to keep it clean for the demo
     # In a real app, we might manage sessions
-    for filename in os.listdir(UPLOAD_DIR):
-        file_path = os.path.join(UPLOAD_DIR, filename)
-        try:
-            if os.path.isfile(file_path) or os.path.islink(file_path):
-                os.unlink(file_path)
-        except Exception as e:
-            print(f'Failed to delete {file_path}. Reason: {e}')
+    # scandir reports the entry type without an extra stat per file
+    with os.scandir(UPLOAD_DIR) as entries:
+        for entry in entries:
+            try:
+                if entry.is_file(follow_symlinks=False) or entry.is_symlink():
+                    os.unlink(entry.path)
+            except Exception as e:
+                print(f'Failed to delete {entry.path}. Reason: {e}')
 
     for file in files:
         file_path = os.path.join(UPLOAD_DIR, file.filename)
-        with open(file_path, "wb") as buffer:
-            shutil.copyfileobj(file.file, buffer)
+        # Stream asynchronously so large uploads don't block the event loop
+        async with aiofiles.open(file_path, "wb") as buffer:
+            while chunk := await file.read(UPLOAD_CHUNK_SIZE):
+                await buffer.write(chunk)
         saved_paths.append(file_path)
     
     return {"message": f"Successfully uploaded {len(saved_paths)} files", "filenames": [f.filename for f in files]}
 
 @app.post("/build-knowledge-base")
 async def build_knowledge_base():
-    files = [os.path.join(UPLOAD_DIR, f) for f in os.listdir(UPLOAD_DIR)]
+    # Classify uploads in a single scandir pass
+    html_files, support_files = [], []
+    with os.scandir(UPLOAD_DIR) as entries:
+        for entry in entries:
+            if not entry.is_file():
+                continue
+            if entry.name.lower().endswith(HTML_EXTENSIONS):
+                html_files.append(entry.path)
+            else:
+                support_files.append(entry.path)
+    files = html_files + support_files
 
     if not files:
         raise HTTPException(status_code=400, detail="Upload at least one support document and checkout.html before building the knowledge base.")
 
-    html_files = [f for f in files if os.path.splitext(f)[1].lower() in HTML_EXTENSIONS]
-    support_files = [f for f in files if os.path.splitext(f)[1].lower() not in HTML_EXTENSIONS]
-
     if not html_files:
         raise HTTPException(status_code=400, detail="checkout.html (or another HTML file) is required to build the knowledge base.")
     if not support_files:
         raise HTTPException(status_code=400, detail="At least one support document (MD, TXT, JSON, etc.) is required alongside the HTML file.")
 
-    rag_engine.clear_database()
-    num_chunks = rag_engine.ingest_documents(files)
+    # Loading, embedding and index writes are blocking; keep them off the event loop
+    num_chunks = await run_in_threadpool(rag_engine.rebuild, files)
 
     return {"message": "Knowledge Base Built Successfully", "chunks_processed": num_chunks}
 
 @app.post("/generate-test-cases", response_model=TestPlan)
 async def generate_test_cases(request: TestCaseRequest, x_api_key: Optional[str] = Header(None)):
     try:
-        return rag_engine.generate_test_cases(request.query, api_key=x_api_key)
+        # Retrieval and the Gemini call are blocking; keep them off the event loop
+        return await run_in_threadpool(rag_engine.generate_test_cases, request.query, api_key=x_api_key)
     except Exception as e:
         raise HTTPException(status_code=500, detail=str(e))
 
 @app.post("/generate-script", response_model=SeleniumScriptResponse)
 async def generate_script(request: SeleniumScriptRequest, x_api_key: Optional[str] = Header(None)):
     try:
-        script = rag_engine.generate_selenium_script(request.test_case, request.html_content, api_key=x_api_key)
+        script = await run_in_threadpool(
+            rag_engine.generate_selenium_script, request.test_case, request.html_content, api_key=x_api_key
+        )
         return SeleniumScriptResponse(script_code=script)
     except Exception as e:
         raise HTTPException(status_code=500, detail=str(e))
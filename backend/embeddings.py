@@ -0,0 +1,155 @@
+import os
+import shutil
+import tempfile
+from typing import List
+
+import numpy as np
+import torch
+from langchain_core.embeddings import Embeddings
+from sentence_transformers import SentenceTransformer
+from transformers import AutoTokenizer
+
+try:
+    import onnxruntime as ort
+    from optimum.onnxruntime import ORTModelForFeatureExtraction, ORTQuantizer
+    from optimum.onnxruntime.configuration import AutoQuantizationConfig
+except ImportError:  # ONNX runtime is optional; fall back to PyTorch
+    ort = None
+
+EMBEDDING_MODEL = "all-MiniLM-L6-v2"
+EMBEDDING_BATCH_SIZE = 64
+# all-MiniLM-L6-v2 is trained with (and truncates to) 256 word pieces
+EMBEDDING_MAX_LENGTH = 256
+ONNX_MODEL_DIR = "data/onnx_model"
+ONNX_MODEL_FILE = "model_quantized.onnx"
+
+
+def default_device() -> str:
+    return "cuda" if torch.cuda.is_available() else "cpu"
+
+
+class SentenceTransformerEmbeddings(Embeddings):
+    """Thin wrapper around a SentenceTransformer model on the best available device.
+
+    ``encode`` already sorts inputs by length before batching, so documents are
+    passed through as-is.
+    """
+
+    def __init__(self, model_name: str = EMBEDDING_MODEL, device: str | None = None, batch_size: int = EMBEDDING_BATCH_SIZE):
+        self.model_name = model_name
+        # Identifies the vectors this backend produces, for the embedding cache
+        self.cache_namespace = model_name
+        self.device = device or default_device()
+        self.batch_size = batch_size
+        self._st_model = SentenceTransformer(model_name, device=self.device)
+
+    def embed_documents(self, texts: List[str]) -> List[List[float]]:
+        if not texts:
+            return []
+        return self._st_model.encode(
+            texts,
+            batch_size=self.batch_size,
+            convert_to_numpy=True,
+            show_progress_bar=False,
+        ).tolist()
+
+    def embed_query(self, text: str) -> List[float]:
+        return self._st_model.encode(text, convert_to_numpy=True, show_progress_bar=False).tolist()
+
+
+class ONNXEmbeddings(Embeddings):
+    """all-MiniLM-L6-v2 exported to ONNX with int8 dynamic quantization.
+
+    The quantized model must already exist in ``onnx_path``; it is produced
+    once at build time by ``python -m scripts.export_onnx_model``. Pooling and normalisation mirror the SentenceTransformer pipeline
+    (masked mean pooling followed by L2 normalisation).
+    """
+
+    def __init__(self, onnx_path: str = ONNX_MODEL_DIR, model_name: str = EMBEDDING_MODEL, batch_size: int = EMBEDDING_BATCH_SIZE):
+        self.model_name = model_name
+        # Quantized vectors differ slightly from FP32 ones, so cache them separately
+        self.cache_namespace = f"{model_name}:onnx-int8"
+        self.batch_size = batch_size
+        model_file = os.path.join(onnx_path, ONNX_MODEL_FILE)
+        if not os.path.exists(model_file):
+            raise FileNotFoundError(f"{model_file} not found; run `python -m scripts.export_onnx_model` first")
+        self.tokenizer = AutoTokenizer.from_pretrained(onnx_path)
+        self.session = ort.InferenceSession(model_file, providers=["CPUExecutionProvider"])
+        self._input_names = {node.name for node in self.session.get_inputs()}
+
+    def _encode(self, texts: List[str]) -> np.ndarray:
+        inputs = self.tokenizer(
+            texts,
+            padding=True,
+            truncation=True,
+            max_length=EMBEDDING_MAX_LENGTH,
+            return_tensors="np",
+        )
+        hidden = self.session.run(None, {name: value for name, value in inputs.items() if name in self._input_names})[0]
+        mask = inputs["attention_mask"][..., None].astype(np.float32)
+        pooled = (hidden * mask).sum(axis=1) / np.clip(mask.sum(axis=1), 1e-9, None)
+        return pooled / np.clip(np.linalg.norm(pooled, axis=1, keepdims=True), 1e-12, None)
+
+    def embed_documents(self, texts: List[str]) -> List[List[float]]:
+        if not texts:
+            return []
+        # The tokenizer pads each batch to its longest text, so batch texts of
+        # similar length together and scatter the results back afterwards
+        order = np.argsort([len(text) for text in texts], kind="stable")
+        sorted_texts = [texts[i] for i in order]
+        embs_sorted = np.concatenate([
+            self._encode(sorted_texts[start:start + self.batch_size])
+            for start in range(0, len(sorted_texts), self.batch_size)
+        ])
+        embs = np.empty_like(embs_sorted)
+        embs[order] = embs_sorted
+        return embs.tolist()
+
+    def embed_query(self, text: str) -> List[float]:
+        return self._encode([text])[0].tolist()
+
+
+def export_quantized_model(model_name: str, save_dir: str):
+    """Export a sentence-transformers checkpoint to ONNX and quantize it to int8.
+
+    The export is written to a temporary sibling directory and moved into place
+    in one step, so concurrent workers never load a half-written model.
+    """
+    model_id = f"sentence-transformers/{model_name}"
+    parent = os.path.dirname(os.path.abspath(save_dir))
+    os.makedirs(parent, exist_ok=True)
+    tmp_dir = tempfile.mkdtemp(prefix=".onnx_export-", dir=parent)
+    try:
+        model = ORTModelForFeatureExtraction.from_pretrained(model_id, export=True)
+        model.save_pretrained(tmp_dir)
+        AutoTokenizer.from_pretrained(model_id).save_pretrained(tmp_dir)
+        quantizer = ORTQuantizer.from_pretrained(model)
+        quantizer.quantize(
+            save_dir=tmp_dir,
+            quantization_config=AutoQuantizationConfig.avx512_vnni(is_static=False, per_channel=False),
+        )
+        if os.path.isdir(save_dir) and not os.path.exists(os.path.join(save_dir, ONNX_MODEL_FILE)):
+            # Leftover from an interrupted export; a completed one always has the model file
+            shutil.rmtree(save_dir, ignore_errors=True)
+        try:
+            os.replace(tmp_dir, save_dir)
+        except OSError:
+            # Another worker finished its export first; use that one
+            if not os.path.exists(os.path.join(save_dir, ONNX_MODEL_FILE)):
+                raise
+    finally:
+        shutil.rmtree(tmp_dir, ignore_errors=True)
+
+
+def build_embeddings() -> Embeddings:
+    # The int8 ONNX model only pays off on CPU; keep PyTorch when a GPU is present.
+    # Startup only loads an existing export: exporting here could outlast the
+    # server's worker boot timeout.
+    device = default_device()
+    if device == "cpu" and ort is not None:
+        try:
+            return ONNXEmbeddings()
+        except Exception as e:
+            # e.g. the model was never exported, or an optimum/transformers mismatch
+            print(f"Warning: ONNX embeddings unavailable, falling back to PyTorch: {e}")
+    return SentenceTransformerEmbeddings(device=device)
@@ -0,0 +1,87 @@
+import json
+import multiprocessing
+import os
+from pathlib import Path
+from typing import List
+from langchain_community.document_loaders import (
+    TextLoader,
+    UnstructuredMarkdownLoader,
+    UnstructuredFileLoader,
+)
+from langchain_core.documents import Document
+
+# Document loading lives apart from the RAG engine so that worker processes
+# only import these loaders, never the embedding model or Chroma.
+
+# A tuple so it works with both `in` and str.endswith
+HTML_EXTENSIONS = (".html", ".htm")
+# Number of processes used to parse support documents; set to 1 on slow
+# (e.g. rotating) disks where parallel reads hurt more than they help.
+LOAD_WORKERS_ENV = "QA_AGENT_LOAD_WORKERS"
+# Starting worker processes costs more than parsing a handful of small files
+LOAD_POOL_MIN_FILES = 8
+
+
+def base_metadata(file_path: str) -> dict:
+    ext = Path(file_path).suffix.lower()
+    return {
+        "source_document": os.path.basename(file_path),
+        "doc_type": "html" if ext in HTML_EXTENSIONS else "support"
+    }
+
+
+def load_with_metadata(file_path: str) -> List[Document]:
+    ext = Path(file_path).suffix.lower()
+    metadata = base_metadata(file_path)
+
+    if ext == ".md":
+        loader = UnstructuredMarkdownLoader(file_path)
+        docs = loader.load()
+    elif ext in {".txt"}:
+        loader = TextLoader(file_path, encoding="utf-8")
+        docs = loader.load()
+    elif ext in {".json"}:
+        docs = _load_json(file_path, metadata)
+    elif ext in {".pdf"}:
+        loader = UnstructuredFileLoader(file_path)
+        docs = loader.load()
+    else:
+        loader = TextLoader(file_path, encoding="utf-8")
+        docs = loader.load()
+
+    for doc in docs:
+        doc.metadata.setdefault("source_document", metadata["source_document"])
+        doc.metadata.setdefault("doc_type", metadata["doc_type"])
+
+    return docs
+
+
+def _load_json(file_path: str, metadata: dict) -> List[Document]:
+    with open(file_path, "r", encoding="utf-8") as f:
+        data = json.load(f)
+    # Single-line encoding: no indentation padding, but keep the space after
+    # separators so the text splitter still has word boundaries to split on
+    flattened = json.dumps(data, ensure_ascii=False)
+    return [Document(page_content=flattened, metadata=metadata)]
+
+
+def _load_workers(num_files: int) -> int:
+    workers = (os.cpu_count() or 1) - 1
+    override = os.getenv(LOAD_WORKERS_ENV)
+    if override:
+        try:
+            workers = int(override)
+        except ValueError:
+            print(f"Warning: Ignoring invalid {LOAD_WORKERS_ENV}={override!r}; using the default worker count")
+    return max(1, min(workers, num_files))
+
+
+def load_support_documents(file_paths: List[str]) -> List[Document]:
+    workers = _load_workers(len(file_paths))
+    if len(file_paths) < LOAD_POOL_MIN_FILES or workers < 2:
+        return [doc for file_path in file_paths for doc in load_with_metadata(file_path)]
+    # Spawn on every platform: forking the threaded API process is unsafe, and
+    # children then import only this module (and the now-light app module).
+    with multiprocessing.get_context("spawn").Pool(workers) as pool:
+        nested = pool.map(load_with_metadata, file_paths)
+    return [doc for docs in nested for doc in docs]
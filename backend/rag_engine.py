@@ -1,198 +1,396 @@
+import hashlib
 import json
+import mmap
 import os
 import re
+import threading
+import uuid
+from concurrent.futures import ThreadPoolExecutor
+from functools import lru_cache
 from pathlib import Path
 from typing import List, Tuple
-from bs4 import BeautifulSoup
-from langchain_community.document_loaders import (
-    TextLoader,
-    UnstructuredMarkdownLoader,
-    UnstructuredFileLoader,
-)
+import chromadb
+import diskcache
+import numpy as np
+from bs4 import BeautifulSoup, Comment
 from langchain_text_splitters import RecursiveCharacterTextSplitter
 from langchain_chroma import Chroma
-from langchain_community.embeddings import SentenceTransformerEmbeddings
 from langchain_google_genai import ChatGoogleGenerativeAI
 from langchain_core.prompts import ChatPromptTemplate
 from langchain_core.output_parsers import JsonOutputParser, StrOutputParser
 from langchain_core.documents import Document
 from backend.models import TestPlan, TestCase
+from backend.embeddings import build_embeddings
+from backend.loaders import HTML_EXTENSIONS, base_metadata, load_support_documents
 
 # Persistence directory for Chroma
 CHROMA_PATH = "data/chroma_db"
+# Set CHROMA_HOST to use a separate Chroma server (`chroma run --path data/chroma_db --port 8010`)
+# instead of the in-process store, keeping index writes out of the API workers.
+# The default port stays clear of the API's own port 8000.
+CHROMA_HOST = os.getenv("CHROMA_HOST")
+CHROMA_PORT = int(os.getenv("CHROMA_PORT", "8010"))
+# Chroma inserts are fastest in batches of a few hundred rows
+CHROMA_INSERT_BATCH_SIZE = 200
+# Concurrent insert requests against a Chroma server; returns diminish past ~4
+CHROMA_INSERT_CONCURRENCY = 4
 UPLOAD_DIR = "data/uploads"
+# On-disk chunk embedding cache, shared across rebuilds and worker processes
+EMBEDDING_CACHE_PATH = "data/emb_cache"
+# Sidecar selector indexes for ingested HTML, so validation survives restarts
+# without reparsing. Kept outside UPLOAD_DIR so they are never ingested.
+HTML_INDEX_DIR = "data/html_index"
+# C-backed parser; noticeably faster than the pure-Python "html.parser"
+HTML_PARSER = "lxml"
+
+# Prompts and parsers carry no per-request state, so build them once
+_TEST_CASE_PROMPT = ChatPromptTemplate.from_template("""You are an expert QA Automation Engineer.
+The retrieved context snippets are each prefixed with [Source:<filename>].
+Use ONLY this information to build:
+- A list called "test_viewpoints" describing 3-5 distinct ways to look at the system under test.
+- A "test_cases" list with detailed cases grounded in the sources.
+
+Context:
+{context}
+
+User Request: {query}
+
+Rules:
+1. Do not invent features that are not explicitly mentioned.
+2. Every test case must include: "test_id", "feature", "test_scenario", "expected_result", "grounded_in".
+3. The "grounded_in" value must match one of the source filenames in the context.
+4. Provide at least one positive and one negative scenario when the context allows it.
+5. Return valid JSON with keys: "test_viewpoints" and "test_cases".
+""")
+
+_SCRIPT_PROMPT = ChatPromptTemplate.from_template("""You are an expert Python Selenium Developer.
+Generate a complete, runnable Python Selenium script for the following test case.
+
+Test Case:
+ID: {test_id}
+Scenario: {scenario}
+Expected Result: {expected}
+
+Target HTML Page Source:
+{html_content}
+
+Relevant Documentation Context:
+{context}
+
+Requirements:
+1. Use 'webdriver.Chrome()'.
+2. Assume the HTML file is located at 'file:///path/to/checkout.html' (use a placeholder path).
+3. Use explicit waits (WebDriverWait) instead of sleep where possible.
+4. Use precise selectors based on the provided HTML (IDs, classes, names).
+5. Include assertions to verify the Expected Result and echo the success message when appropriate.
+6. Return ONLY the Python code, no markdown formatting.
+""")
+
+_TEST_PLAN_PARSER = JsonOutputParser(pydantic_object=TestPlan)
+_SELECTOR_RE = re.compile(r"By\.(ID|NAME|CSS_SELECTOR)\s*,\s*['\"]([^'\"]+)['\"]")
+_WHITESPACE_RE = re.compile(r"\s+")
+
+# What the script prompt keeps of the checkout page: markup, selector-relevant
+# attributes, inline scripts (they hold the messages tests assert on) and any
+# CSS that decides whether an element starts hidden (tests wait on it).
+_PROMPT_HTML_DROP_TAGS = ["svg", "noscript", "link", "meta"]
+_PROMPT_HTML_ATTRS = frozenset({
+    "id", "name", "class", "type", "placeholder", "role", "for", "href", "value",
+    "required", "checked", "disabled", "selected", "hidden",
+})
+_PROMPT_HTML_ATTR_PREFIXES = ("data-", "aria-", "on")
+_VISIBILITY_CSS_PROPS = ("display", "visibility")
+_CSS_COMMENT_RE = re.compile(r"/\*.*?\*/", re.DOTALL)
+# Innermost `selector { declarations }` blocks; at-rule wrappers are not kept
+_CSS_RULE_RE = re.compile(r"([^{}]+)\{([^{}]*)\}")
+
+
+def _extract_selectors(soup: BeautifulSoup) -> Tuple[set, set, set]:
+    # Collect ids, names and classes in a single walk over the tree
+    html_ids, html_names, html_classes = set(), set(), set()
+    for tag in soup.find_all(True):
+        attrs = tag.attrs
+        if tag_id := attrs.get("id"):
+            html_ids.add(tag_id)
+        if name := attrs.get("name"):
+            html_names.add(name)
+        if classes := attrs.get("class"):
+            html_classes.update(classes)
+    return html_ids, html_names, html_classes
+
+
+@lru_cache(maxsize=8)
+def _make_llm(api_key: str) -> ChatGoogleGenerativeAI:
+    # One client per key so its HTTP connections are reused across requests
+    return ChatGoogleGenerativeAI(
+        model="gemini-2.0-flash",
+        temperature=0,
+        google_api_key=api_key
+    )
+
+
+def _selector_index_path(html_path: str) -> str:
+    return os.path.join(HTML_INDEX_DIR, f"{os.path.basename(html_path)}.idx.json")
+
+
+def _write_selector_index(html_path: str, selectors: Tuple[set, set, set]):
+    html_ids, html_names, html_classes = selectors
+    os.makedirs(HTML_INDEX_DIR, exist_ok=True)
+    with open(_selector_index_path(html_path), "w", encoding="utf-8") as f:
+        json.dump({"ids": sorted(html_ids), "names": sorted(html_names), "classes": sorted(html_classes)}, f)
+
+
+def _read_selector_index(html_path: str) -> Tuple[set, set, set] | None:
+    index_path = _selector_index_path(html_path)
+    try:
+        # An index older than the HTML file is stale
+        if os.path.getmtime(index_path) < os.path.getmtime(html_path):
+            return None
+        with open(index_path, "r", encoding="utf-8") as f:
+            data = json.load(f)
+        return set(data["ids"]), set(data["names"]), set(data["classes"])
+    except (OSError, ValueError, KeyError):
+        return None
+
+
+def _read_html(file_path: str) -> str:
+    # Decode straight from a read-only mapping instead of a buffered text reader.
+    # The mapping is closed right away so the upload can still be deleted on Windows.
+    with open(file_path, "rb") as f:
+        if os.fstat(f.fileno()).st_size == 0:
+            return ""
+        with mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ) as mm:
+            return str(mm, "utf-8")
+
+
+def _minify_html_for_prompt(html: str) -> str:
+    return _minify_soup(BeautifulSoup(html, HTML_PARSER))
+
+
+def _visibility_declarations(declarations: str) -> str:
+    kept = [
+        _WHITESPACE_RE.sub(" ", declaration).strip()
+        for declaration in declarations.split(";")
+        if ":" in declaration and declaration.split(":", 1)[0].strip().lower() in _VISIBILITY_CSS_PROPS
+    ]
+    return "; ".join(kept)
+
+
+def _visibility_css(css: str) -> str:
+    rules = []
+    for selector, declarations in _CSS_RULE_RE.findall(_CSS_COMMENT_RE.sub("", css)):
+        if kept := _visibility_declarations(declarations):
+            rules.append(f"{_WHITESPACE_RE.sub(' ', selector).strip()} {{ {kept} }}")
+    return " ".join(rules)
+
+
+def _minify_soup(soup: BeautifulSoup) -> str:
+    # Mutates the soup in place
+    for tag in soup.find_all(_PROMPT_HTML_DROP_TAGS):
+        tag.decompose()
+    for tag in soup.find_all("style"):
+        if css := _visibility_css(tag.get_text()):
+            tag.string = css
+        else:
+            tag.decompose()
+    for comment in soup.find_all(string=lambda text: isinstance(text, Comment)):
+        comment.extract()
+    for tag in soup.find_all(True):
+        attrs = {
+            key: value for key, value in tag.attrs.items()
+            if key in _PROMPT_HTML_ATTRS or key.startswith(_PROMPT_HTML_ATTR_PREFIXES)
+        }
+        if style := _visibility_declarations(tag.attrs.get("style", "")):
+            attrs["style"] = style
+        tag.attrs = attrs
+    for text in soup.find_all(string=True):
+        if text.parent.name == "script":
+            continue
+        collapsed = _WHITESPACE_RE.sub(" ", text)
+        if collapsed != text:
+            text.replace_with(collapsed)
+    return str(soup).strip()
+
 
 class RAGEngine:
     def __init__(self):
         # Initialize Embeddings (using a local model to avoid API costs for embeddings)
-        self.embedding_function = SentenceTransformerEmbeddings(model_name="all-MiniLM-L6-v2")
+        self.embedding_function = build_embeddings()
         
         # Initialize Vector Store
-        self.vector_store = Chroma(
-            persist_directory=CHROMA_PATH,
-            embedding_function=self.embedding_function
-        )
+        self.vector_store = self._make_vector_store()
+        self._emb_cache = diskcache.Cache(EMBEDDING_CACHE_PATH)
         self.latest_html_path: str | None = None
         self.latest_html_content: str | None = None
+        # (ids, names, classes) found in each ingested HTML file, keyed by path
+        self._html_selector_cache: dict[str, Tuple[set, set, set]] = {}
+        # Trimmed-down checkout markup sent to the script prompt, keyed by path
+        self._minified_html_cache: dict[str, str] = {}
+        # Guards the vector store and the latest-HTML state. Rebuilds hold it for
+        # their whole run; generation holds it only while retrieving and reading
+        # HTML state, not during the LLM call.
+        self._lock = threading.RLock()
         
+    def _make_vector_store(self) -> Chroma:
+        if CHROMA_HOST:
+            return Chroma(
+                client=chromadb.HttpClient(host=CHROMA_HOST, port=CHROMA_PORT),
+                embedding_function=self.embedding_function
+            )
+        return Chroma(
+            persist_directory=CHROMA_PATH,
+            embedding_function=self.embedding_function
+        )
+
     def _get_llm(self, api_key: str = None):
         # Use provided key, or fall back to env var, or placeholder
         final_key = api_key or os.getenv("GOOGLE_API_KEY", "AIza-placeholder")
-        return ChatGoogleGenerativeAI(
-            model="gemini-2.0-flash",
-            temperature=0,
-            google_api_key=final_key
-        )
+        return _make_llm(final_key)
 
     def ingest_documents(self, file_paths: List[str]):
-        documents: List[Document] = []
-        for file_path in file_paths:
-            docs = self._load_with_metadata(file_path)
-            documents.extend(docs)
-
-        text_splitter = RecursiveCharacterTextSplitter(chunk_size=1200, chunk_overlap=150)
-        chunks = text_splitter.split_documents(documents)
-        self.vector_store.add_documents(chunks)
-        return len(chunks)
-
-    def _load_with_metadata(self, file_path: str) -> List[Document]:
-        ext = Path(file_path).suffix.lower()
-        base_metadata = {
-            "source_document": os.path.basename(file_path),
-            "doc_type": "html" if ext in {".html", ".htm"} else "support"
-        }
+        with self._lock:
+            html_paths = [f for f in file_paths if Path(f).suffix.lower() in HTML_EXTENSIONS]
+            support_paths = [f for f in file_paths if Path(f).suffix.lower() not in HTML_EXTENSIONS]
 
-        if ext == ".md":
-            loader = UnstructuredMarkdownLoader(file_path)
-            docs = loader.load()
-        elif ext in {".txt"}:
-            loader = TextLoader(file_path, encoding="utf-8")
-            docs = loader.load()
-        elif ext in {".json"}:
-            docs = self._load_json(file_path, base_metadata)
-        elif ext in {".html", ".htm"}:
-            docs = self._load_html(file_path, base_metadata)
-        elif ext in {".pdf"}:
-            loader = UnstructuredFileLoader(file_path)
-            docs = loader.load()
-        else:
-            loader = TextLoader(file_path, encoding="utf-8")
-            docs = loader.load()
+            # Support documents may be parsed in worker processes; HTML is loaded
+            # here because it also records the latest checkout page on the engine.
+            documents: List[Document] = load_support_documents(support_paths)
+            for file_path in html_paths:
+                documents.extend(self._load_html(file_path, base_metadata(file_path)))
 
-        for doc in docs:
-            doc.metadata.setdefault("source_document", base_metadata["source_document"])
-            doc.metadata.setdefault("doc_type", base_metadata["doc_type"])
+            text_splitter = RecursiveCharacterTextSplitter(chunk_size=1200, chunk_overlap=150)
+            chunks = text_splitter.split_documents(documents)
+            if not chunks:
+                return 0
 
-        return docs
+            # Embed every chunk in one batched call and write them with batched
+            # collection inserts instead of letting Chroma embed row by row.
+            texts = [chunk.page_content for chunk in chunks]
+            metadatas = [chunk.metadata for chunk in chunks]
+            ids = [uuid.uuid4().hex for _ in chunks]
+            embeddings = self._embed_with_cache(texts)
+            self._add_in_batches(ids, embeddings, metadatas, texts)
+            return len(chunks)
 
-    def _load_json(self, file_path: str, metadata: dict) -> List[Document]:
-        with open(file_path, "r", encoding="utf-8") as f:
-            data = json.load(f)
-        flattened = json.dumps(data, indent=2)
-        return [Document(page_content=flattened, metadata=metadata)]
+    def _add_in_batches(self, ids: List[str], embeddings: List[List[float]], metadatas: List[dict], texts: List[str]):
+        def add_batch(start: int):
+            end = start + CHROMA_INSERT_BATCH_SIZE
+            self.vector_store._collection.add(
+                ids=ids[start:end],
+                embeddings=embeddings[start:end],
+                metadatas=metadatas[start:end],
+                documents=texts[start:end],
+            )
+
+        starts = range(0, len(ids), CHROMA_INSERT_BATCH_SIZE)
+        if not CHROMA_HOST:
+            # The embedded store serialises writes on SQLite, so concurrency would not help
+            for start in starts:
+                add_batch(start)
+            return
+        with ThreadPoolExecutor(max_workers=CHROMA_INSERT_CONCURRENCY) as executor:
+            # list() surfaces the first failed batch as an exception
+            list(executor.map(add_batch, starts))
+
+    def _embed_with_cache(self, texts: List[str]) -> List[List[float]]:
+        # Re-uploaded documents mostly produce the same chunks; only embed the new ones
+        namespace = self.embedding_function.cache_namespace
+        keys = [hashlib.sha256(f"{namespace}\0{text}".encode("utf-8")).hexdigest() for text in texts]
+        embeddings: List[List[float] | None] = [None] * len(texts)
+        missing = []
+        for i, key in enumerate(keys):
+            cached = self._emb_cache.get(key)
+            if cached is None:
+                missing.append(i)
+            else:
+                embeddings[i] = np.frombuffer(cached, dtype=np.float32).tolist()
+
+        if missing:
+            fresh = self.embedding_function.embed_documents([texts[i] for i in missing])
+            with self._emb_cache.transact():
+                for i, vector in zip(missing, fresh):
+                    self._emb_cache.set(keys[i], np.asarray(vector, dtype=np.float32).tobytes())
+                    embeddings[i] = vector
+        return embeddings
 
     def _load_html(self, file_path: str, metadata: dict) -> List[Document]:
-        with open(file_path, "r", encoding="utf-8") as f:
-            raw_html = f.read()
-        soup = BeautifulSoup(raw_html, "html.parser")
+        raw_html = _read_html(file_path)
+        # One parse serves the document text, the selector index and the prompt copy
+        soup = BeautifulSoup(raw_html, HTML_PARSER)
         text = soup.get_text(separator="\n")
         self.latest_html_path = file_path
         self.latest_html_content = raw_html
+        selectors = _extract_selectors(soup)
+        self._html_selector_cache[file_path] = selectors
+        _write_selector_index(file_path, selectors)
+        self._minified_html_cache[file_path] = _minify_soup(soup)
         return [Document(page_content=text, metadata=metadata)]
 
+    def rebuild(self, file_paths: List[str]) -> int:
+        # Clear and ingest as one step so concurrent rebuilds and readers never
+        # observe a half-built store
+        with self._lock:
+            self.clear_database()
+            return self.ingest_documents(file_paths)
+
     def clear_database(self):
-        try:
-            # Try to delete the collection directly to avoid file lock issues on Windows
-            self.vector_store.delete_collection()
-        except Exception as e:
-            print(f"Warning: Could not delete collection: {e}")
+        with self._lock:
+            try:
+                # Try to delete the collection directly to avoid file lock issues on Windows
+                self.vector_store.delete_collection()
+            except Exception as e:
+                print(f"Warning: Could not delete collection: {e}")
         
-        # Re-initialize to ensure we have a fresh start (and create collection if needed)
-        self.vector_store = Chroma(
-            persist_directory=CHROMA_PATH,
-            embedding_function=self.embedding_function
-        )
-        self.latest_html_path = None
-        self.latest_html_content = None
+            # Re-initialize to ensure we have a fresh start (and create collection if needed)
+            self.vector_store = self._make_vector_store()
+            self.latest_html_path = None
+            self.latest_html_content = None
+            self._html_selector_cache.clear()
+            self._minified_html_cache.clear()
 
     def generate_test_cases(self, query: str, api_key: str = None) -> TestPlan:
-        retriever = self.vector_store.as_retriever(search_kwargs={"k": 6})
-        context_docs = retriever.invoke(query)
+        with self._lock:
+            retriever = self.vector_store.as_retriever(search_kwargs={"k": 6})
+            context_docs = retriever.invoke(query)
         allowed_sources = self._collect_sources(context_docs)
         context_text = self._format_docs(context_docs)
 
         llm = self._get_llm(api_key)
-        template = """You are an expert QA Automation Engineer.
-        The retrieved context snippets are each prefixed with [Source:<filename>].
-        Use ONLY this information to build:
-        - A list called "test_viewpoints" describing 3-5 distinct ways to look at the system under test.
-        - A "test_cases" list with detailed cases grounded in the sources.
-
-        Context:
-        {context}
-
-        User Request: {query}
-
-        Rules:
-        1. Do not invent features that are not explicitly mentioned.
-        2. Every test case must include: "test_id", "feature", "test_scenario", "expected_result", "grounded_in".
-        3. The "grounded_in" value must match one of the source filenames in the context.
-        4. Provide at least one positive and one negative scenario when the context allows it.
-        5. Return valid JSON with keys: "test_viewpoints" and "test_cases".
-        """
-        
-        prompt = ChatPromptTemplate.from_template(template)
-        parser = JsonOutputParser(pydantic_object=TestPlan)
-
-        chain = prompt | llm | parser
+        chain = _TEST_CASE_PROMPT | llm | _TEST_PLAN_PARSER
         result = chain.invoke({"context": context_text, "query": query})
         test_plan = TestPlan(**result)
         self._validate_grounding(test_plan, allowed_sources)
         return test_plan
 
     def generate_selenium_script(self, test_case: TestCase, html_content: str | None = None, api_key: str = None) -> str:
-        support_retriever = self.vector_store.as_retriever(search_kwargs={"k": 3, "filter": {"doc_type": "support"}})
-        docs = support_retriever.invoke(test_case.feature)
-        html_context_docs = self._get_html_documents()
-        combined_context = self._format_docs(docs + html_context_docs)
+        with self._lock:
+            # One unfiltered search (one query embedding) usually covers both doc types;
+            # the filtered retrievers top up whichever type came back with fewer than 3.
+            # The prompt context is therefore up to 3 support + 3 HTML chunks
+            # (at most ~7.2k characters with 1200-character chunks).
+            results = self.vector_store.similarity_search(test_case.feature, k=8)
+            docs = [doc for doc in results if doc.metadata.get("doc_type") == "support"][:3]
+            html_context_docs = [doc for doc in results if doc.metadata.get("doc_type") == "html"][:3]
+            if len(docs) < 3:
+                support_retriever = self.vector_store.as_retriever(search_kwargs={"k": 3, "filter": {"doc_type": "support"}})
+                docs = self._top_up(docs, support_retriever.invoke(test_case.feature))
+            if len(html_context_docs) < 3:
+                html_context_docs = self._top_up(html_context_docs, self._get_html_documents())
 
-        html_source = html_content or self._get_latest_html_content()
-        if not html_source:
-            raise ValueError("No checkout HTML is available. Rebuild the knowledge base with checkout.html included.")
+            html_source = html_content or self._get_latest_html_content()
+            if not html_source:
+                raise ValueError("No checkout HTML is available. Rebuild the knowledge base with checkout.html included.")
+        prompt_html = self._get_prompt_html(html_source)
+        combined_context = self._format_docs(docs + html_context_docs)
         llm = self._get_llm(api_key)
 
-        template = """You are an expert Python Selenium Developer.
-        Generate a complete, runnable Python Selenium script for the following test case.
-        
-        Test Case:
-        ID: {test_id}
-        Scenario: {scenario}
-        Expected Result: {expected}
-        
-        Target HTML Page Source:
-        {html_content}
-        
-        Relevant Documentation Context:
-        {context}
-        
-        Requirements:
-        1. Use 'webdriver.Chrome()'.
-        2. Assume the HTML file is located at 'file:///path/to/checkout.html' (use a placeholder path).
-        3. Use explicit waits (WebDriverWait) instead of sleep where possible.
-        4. Use precise selectors based on the provided HTML (IDs, classes, names).
-        5. Include assertions to verify the Expected Result and echo the success message when appropriate.
-        6. Return ONLY the Python code, no markdown formatting.
-        """
-        
-        prompt = ChatPromptTemplate.from_template(template)
-        
-        chain = prompt | llm | StrOutputParser()
+        chain = _SCRIPT_PROMPT | llm | StrOutputParser()
         
         script = chain.invoke({
             "test_id": test_case.test_id,
             "scenario": test_case.test_scenario,
             "expected": test_case.expected_result,
-            "html_content": html_source,
+            "html_content": prompt_html,
             "context": combined_context
         })
         
@@ -201,6 +399,17 @@ class RAGEngine:
         self._validate_selenium_script(script, html_source)
         return script
 
+    def _top_up(self, docs: List[Document], extra: List[Document], limit: int = 3) -> List[Document]:
+        seen = {(doc.metadata.get("source_document"), doc.page_content) for doc in docs}
+        for doc in extra:
+            if len(docs) >= limit:
+                break
+            key = (doc.metadata.get("source_document"), doc.page_content)
+            if key not in seen:
+                seen.add(key)
+                docs.append(doc)
+        return docs
+
     def _format_docs(self, docs: List[Document]) -> str:
         if not docs:
             return ""
@@ -210,38 +419,39 @@ class RAGEngine:
             formatted.append(f"[Source:{source}]\n{doc.page_content.strip()}" )
         return "\n\n".join(formatted)
 
-    def _collect_sources(self, docs: List[Document]) -> set:
-        return {doc.metadata.get("source_document", "unknown") for doc in docs if doc.metadata.get("source_document")}
+    def _collect_sources(self, docs: List[Document]) -> frozenset:
+        # Names are stripped here so grounding checks can compare them directly
+        return frozenset(source.strip() for doc in docs if (source := doc.metadata.get("source_document")))
 
-    def _validate_grounding(self, test_plan: TestPlan, allowed_sources: set):
+    def _validate_grounding(self, test_plan: TestPlan, allowed_sources: frozenset):
         if not allowed_sources:
             return
-        invalid_cases = []
-        for case in test_plan.test_cases:
-            grounded = (case.grounded_in or "").strip()
-            if grounded not in allowed_sources:
-                invalid_cases.append((case.test_id, grounded))
-        if invalid_cases:
-            detail = ", ".join([f"{tid}:{src or 'missing'}" for tid, src in invalid_cases])
-            raise ValueError(f"Grounding validation failed. Unknown sources referenced: {detail}")
+
+        def is_grounded(case: TestCase) -> bool:
+            # Exact matches are the common case; only strip when that misses
+            return case.grounded_in in allowed_sources or (case.grounded_in or "").strip() in allowed_sources
+
+        cases = test_plan.test_cases
+        first_invalid = next((i for i, case in enumerate(cases) if not is_grounded(case)), None)
+        if first_invalid is None:
+            return
+        invalid_cases = [
+            (case.test_id, (case.grounded_in or "").strip())
+            for case in cases[first_invalid:] if not is_grounded(case)
+        ]
+        detail = ", ".join([f"{tid}:{src or 'missing'}" for tid, src in invalid_cases])
+        raise ValueError(f"Grounding validation failed. Unknown sources referenced: {detail}")
 
     def _validate_selenium_script(self, script: str, html_source: str):
-        soup = BeautifulSoup(html_source, "html.parser")
-        html_ids = {tag.get("id") for tag in soup.find_all(id=True) if tag.get("id")}
-        html_names = {tag.get("name") for tag in soup.find_all(attrs={"name": True}) if tag.get("name")}
-        html_classes = set()
-        for tag in soup.find_all(class_=True):
-            classes = tag.get("class", [])
-            for cls in classes:
-                html_classes.add(cls)
-
-        selector_pattern = re.compile(r"By\.(ID|NAME|CSS_SELECTOR)\s*,\s*['\"]([^'\"]+)['\"]")
-        matches = selector_pattern.findall(script)
+        html_ids, html_names, html_classes = self._get_html_selectors(html_source)
+
+        matches = _SELECTOR_RE.findall(script)
         if not matches:
             raise ValueError("Generated script lacks identifiable By.ID/NAME/CSS_SELECTOR references. Please regenerate.")
 
         missing = []
-        for method, selector in matches:
+        # Scripts reuse the same locators many times; check each distinct one once
+        for method, selector in dict.fromkeys(matches):
             if method == "ID" and selector not in html_ids:
                 missing.append((method, selector))
             elif method == "NAME" and selector not in html_names:
@@ -256,21 +466,56 @@ class RAGEngine:
             detail = ", ".join([f"{method}:{selector}" for method, selector in missing])
             raise ValueError(f"Generated script references selectors not present in checkout.html: {detail}")
 
+    def _get_html_selectors(self, html_source: str) -> Tuple[set, set, set]:
+        # Only the ingested checkout page is cached; ad-hoc HTML from a request is parsed as-is.
+        # State is read under the lock but parsing happens outside it.
+        with self._lock:
+            latest_path = self.latest_html_path
+            is_latest = latest_path is not None and html_source == self.latest_html_content
+            selectors = self._html_selector_cache.get(latest_path) if is_latest else None
+        if not is_latest:
+            return _extract_selectors(BeautifulSoup(html_source, HTML_PARSER))
+        if selectors is not None:
+            return selectors
+
+        selectors = _read_selector_index(latest_path)
+        parsed = selectors is None
+        if parsed:
+            selectors = _extract_selectors(BeautifulSoup(html_source, HTML_PARSER))
+        with self._lock:
+            # A rebuild may have replaced the page in the meantime
+            if self.latest_html_path == latest_path and self.latest_html_content == html_source:
+                if parsed:
+                    _write_selector_index(latest_path, selectors)
+                self._html_selector_cache[latest_path] = selectors
+        return selectors
+
+    def _get_prompt_html(self, html_source: str) -> str:
+        with self._lock:
+            latest_path = self.latest_html_path
+            is_latest = latest_path is not None and html_source == self.latest_html_content
+            if is_latest and latest_path in self._minified_html_cache:
+                return self._minified_html_cache[latest_path]
+        minified = _minify_html_for_prompt(html_source)
+        if is_latest:
+            with self._lock:
+                if self.latest_html_path == latest_path and self.latest_html_content == html_source:
+                    self._minified_html_cache[latest_path] = minified
+        return minified
+
     def _get_latest_html_content(self) -> str | None:
         if self.latest_html_content:
             return self.latest_html_content
         if self.latest_html_path and os.path.exists(self.latest_html_path):
-            with open(self.latest_html_path, "r", encoding="utf-8") as f:
-                self.latest_html_content = f.read()
-                return self.latest_html_content
+            self.latest_html_content = _read_html(self.latest_html_path)
+            return self.latest_html_content
         if os.path.isdir(UPLOAD_DIR):
             for filename in os.listdir(UPLOAD_DIR):
-                if filename.lower().endswith((".html", ".htm")):
+                if filename.lower().endswith(HTML_EXTENSIONS):
                     html_path = os.path.join(UPLOAD_DIR, filename)
-                    with open(html_path, "r", encoding="utf-8") as f:
-                        self.latest_html_content = f.read()
-                        self.latest_html_path = html_path
-                        return self.latest_html_content
+                    self.latest_html_content = _read_html(html_path)
+                    self.latest_html_path = html_path
+                    return self.latest_html_content
         return None
 
     def _get_html_documents(self) -> List[Document]:
@@ -6,6 +6,14 @@ import pandas as pd
 
 # Configuration
 BACKEND_URL = os.environ.get("BACKEND_URL", "http://localhost:8000")
+TEST_CASE_COLUMNS = ["test_id", "feature", "test_scenario", "expected_result", "grounded_in"]
+
+
+@st.cache_data
+def test_cases_to_df(test_cases):
+    # Every TestCase field is a string, so skip pandas' dtype inference
+    return pd.DataFrame.from_records(test_cases, columns=TEST_CASE_COLUMNS).astype("string")
+
 
 st.set_page_config(page_title="Autonomous QA Agent", layout="wide")
 st.markdown(
@@ -131,7 +139,7 @@ with tab2:
 
         st.write(f"Found {len(test_cases)} test cases:")
         if test_cases:
-            df = pd.DataFrame(test_cases)
+            df = test_cases_to_df(test_cases)
             st.dataframe(df, use_container_width=True)
         else:
             st.info("No test cases returned. Try refining your query.")
@@ -0,0 +1,12 @@
+from backend.embeddings import EMBEDDING_MODEL, ONNX_MODEL_DIR, export_quantized_model, ort
+
+# One-off build step: export and quantize the embedding model so the backend
+# only has to load it at startup. Run from the repo root:
+#   python -m scripts.export_onnx_model
+
+if ort is None:
+    raise SystemExit("onnxruntime/optimum are not installed; the backend will use the PyTorch model.")
+
+print(f"Exporting {EMBEDDING_MODEL} to {ONNX_MODEL_DIR}...")
+export_quantized_model(EMBEDDING_MODEL, ONNX_MODEL_DIR)
+print("Done.")